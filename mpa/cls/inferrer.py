@@ -3,6 +3,7 @@
 #
 from contextlib import nullcontext
 
+import os
 import os.path as osp
 import numpy as np
 import torch
@@ -16,7 +17,7 @@ from mmcls.models import build_classifier
 
 from mpa.registry import STAGES
 from mpa.cls.stage import ClsStage
-from mpa.modules.hooks.auxiliary_hooks import FeatureVectorHook, SaliencyMapHook
+from mpa.modules.hooks.auxiliary_hooks import FeatureVectorHook, MultiAuxiliaryHook, SaliencyMapHook
 from mpa.modules.utils.task_adapt import prob_extractor
 from mpa.utils.logger import get_logger
 logger = get_logger()
@@ -63,14 +64,17 @@ class ClsInferrer(ClsStage):
             self.dataset = build_dataset(cfg.data.test)
 
         # Data loader
+        workers_per_gpu = cfg.data.get('workers_per_gpu', min(4, os.cpu_count() or 1))
+        loader_kwargs = dict(prefetch_factor=4) if workers_per_gpu > 0 else {}
         data_loader = build_dataloader(
             self.dataset,
             samples_per_gpu=cfg.data.samples_per_gpu,
-            workers_per_gpu=cfg.data.workers_per_gpu,
+            workers_per_gpu=workers_per_gpu,
             dist=False,
             shuffle=False,
             round_up=False,
-            persistent_workers=False)
+            persistent_workers=False,
+            **loader_kwargs)
 
         # build the model and load checkpoint
         model = build_classifier(cfg.model)
@@ -99,14 +103,28 @@ class ClsInferrer(ClsStage):
                 data_info['soft_label'] = {task: value[i] for task, value in old_prob.items()}
             outputs = data_infos
         else:
-            with FeatureVectorHook(model.module.backbone) if dump_features else nullcontext() as fhook:
-              with SaliencyMapHook(model.module.backbone) if dump_saliency_map else nullcontext() as shook:
-                  for data in data_loader:
-                      with torch.no_grad():
-                          result = model(return_loss=False, **data)
-                      eval_predictions.extend(result)
-                  feature_vectors = fhook.records if dump_features else [None] * len(self.dataset)
-                  saliency_maps = shook.records if dump_saliency_map else [None] * len(self.dataset)
+            # channels_last only pays off for FP16 convolutions on GPU, which can then use tensor cores
+            channels_last = torch.cuda.is_available() and fp16_cfg is not None
+            if channels_last:
+                model.module.to(memory_format=torch.channels_last)
+            backbone = model.module.backbone
+            feature_vector_hook = FeatureVectorHook(backbone, total_samples=len(self.dataset))
+            saliency_map_hook = SaliencyMapHook(backbone, total_samples=len(self.dataset))
+            hooks = []
+            if dump_features:
+                hooks.append(feature_vector_hook)
+            if dump_saliency_map:
+                hooks.append(saliency_map_hook)
+            # inference_mode (PyTorch>=1.9) also skips view and version counter tracking
+            with getattr(torch, 'inference_mode', torch.no_grad)():
+                with MultiAuxiliaryHook(backbone, hooks) if hooks else nullcontext():
+                    for data in data_loader:
+                        if channels_last:
+                            data['img'] = data['img'].contiguous(memory_format=torch.channels_last)
+                        result = model(return_loss=False, **data)
+                        eval_predictions.extend(result)
+                    feature_vectors = feature_vector_hook.records if dump_features else [None] * len(self.dataset)
+                    saliency_maps = saliency_map_hook.records if dump_saliency_map else [None] * len(self.dataset)
 
         assert len(eval_predictions) == len(feature_vectors) == len(saliency_maps), \
                 'Number of elements should be the same, however, number of outputs are ' \
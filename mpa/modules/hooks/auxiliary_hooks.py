@@ -13,60 +13,255 @@
 # and limitations under the License.
 
 from __future__ import annotations
-from typing import Union
+from abc import ABC, abstractmethod
+from typing import Optional, Union
 
+import numpy as np
 import torch
 
 
-class EigenCamHook:
-    def __init__(self, module: torch.nn.Module) -> None:
+def _normalize_uint8(saliency_map: torch.Tensor) -> torch.Tensor:
+    """Normalize each map in the batch to (0, 255) and cast it to uint8.
+
+    Args:
+        saliency_map (torch.Tensor): batch of maps with shape (bs, h, w)
+
+    Returns:
+        torch.Tensor: normalized maps with the same shape
+    """
+    bs, h, w = saliency_map.size()
+    saliency_map = saliency_map.reshape((bs, h * w)).float()
+    if torch.onnx.is_in_onnx_export():
+        # amin/amax have no ONNX symbolic in the supported torch versions
+        max_values, _ = torch.max(saliency_map, -1, keepdim=True)
+        min_values, _ = torch.min(saliency_map, -1, keepdim=True)
+        saliency_map = 255 * (saliency_map - min_values) / (max_values - min_values + 1e-12)
+    else:
+        # single-pass reductions which do not allocate index tensors
+        max_values = saliency_map.amax(-1, keepdim=True)
+        min_values = saliency_map.amin(-1, keepdim=True)
+        # a per-map scale avoids the per-element division, and subtracting the minimum first keeps an exact zero
+        # for flat maps, which a fused multiply-add with a huge scale would not
+        scale = 255 / (max_values - min_values + 1e-12)
+        saliency_map = (saliency_map - min_values).mul_(scale).clamp_(0, 255)
+    saliency_map = saliency_map.reshape((bs, h, w))
+    return saliency_map.to(torch.uint8)
+
+
+class BaseAuxiliaryHook(ABC):
+    """Base class of the hooks which cache auxiliary outputs of the designated module during forward pass.
+
+    Outputs on GPU are copied to host through a small ring of reused pinned staging buffers without blocking the
+    inference stream, and converted to numpy arrays after synchronization when the records are accessed.
+
+    Args:
+        module (torch.nn.Module): The PyTorch module to be registered in forward pass
+        total_samples (int, optional): The number of samples to be recorded. If given, the records are stored in a
+                                       single preallocated buffer. Defaults to None.
+    """
+    # number of pinned staging buffers, i.e. device to host copies which can be in flight at once
+    _num_staging_buffers = 2
+
+    def __init__(self, module: torch.nn.Module, total_samples: Optional[int] = None) -> None:
         self._module = module
         self._handle = None
         self._records = []
+        self._pending = []
+        self._staging_buffers = [None] * self._num_staging_buffers
+        self._staging_copies = [None] * self._num_staging_buffers
+        self._staging_idx = 0
+        self._total_samples = total_samples
+        self._buffer = None
+        self._num_recorded = 0
 
     @property
     def records(self):
+        self._sync()
         return self._records
 
     @staticmethod
-    def func(x: torch.Tensor) -> torch.Tensor:
-        bs, c, h, w = x.size()
-        reshaped_fmap = x.reshape((bs, c, h * w)).transpose(1, 2)
-        reshaped_fmap = reshaped_fmap - reshaped_fmap.mean(1)[:, None, :]
-        U, S, V = torch.linalg.svd(reshaped_fmap, full_matrices=True)
-        saliency_map = (reshaped_fmap @ V[:, 0][:, :, None]).squeeze(-1)
-        max_values, _ = torch.max(saliency_map, -1)
-        min_values, _ = torch.min(saliency_map, -1)
-        saliency_map = (
-            255
-            * (saliency_map - min_values[:, None])
-            / ((max_values - min_values + 1e-12)[:, None])
-        )
-        saliency_map = saliency_map.reshape((bs, h, w))
-        saliency_map = saliency_map.to(torch.uint8)
-        return saliency_map
+    @abstractmethod
+    def func(*args, **kwargs) -> torch.Tensor:
+        """Generate the auxiliary output to be recorded from the output of the module."""
+
+    def _record(self, tensor: torch.Tensor) -> None:
+        tensor = tensor.detach()
+        if self._total_samples is not None:
+            if self._num_recorded + len(tensor) > self._total_samples:
+                raise RuntimeError(
+                    f'{type(self).__name__} got more than total_samples={self._total_samples} samples to record'
+                )
+            if self._buffer is None:
+                self._buffer = torch.empty((self._total_samples, *tensor.shape[1:]), dtype=tensor.dtype)
+            record = self._buffer[self._num_recorded:self._num_recorded + len(tensor)]
+        elif tensor.is_cuda:
+            record = torch.empty(tensor.size(), dtype=tensor.dtype)
+        else:
+            record = tensor
+        if tensor.is_cuda:
+            self._stage(tensor, record)
+        elif record is not tensor:
+            record.copy_(tensor)
+        self._num_recorded += len(tensor)
+        self._pending.append(record)
+
+    def _stage(self, tensor: torch.Tensor, record: torch.Tensor) -> None:
+        """Copy a GPU tensor into a pinned staging buffer without blocking, and into the record later on."""
+        idx = self._staging_idx
+        self._staging_idx = (idx + 1) % self._num_staging_buffers
+        self._drain(idx)
+        buffer = self._staging_buffers[idx]
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            buffer = torch.empty(tensor.numel(), dtype=tensor.dtype, pin_memory=True)
+            self._staging_buffers[idx] = buffer
+        staged = buffer[:tensor.numel()].view(tensor.size())
+        staged.copy_(tensor, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(tensor.device))
+        self._staging_copies[idx] = (event, staged, record)
+
+    def _drain(self, idx: int) -> None:
+        if self._staging_copies[idx] is None:
+            return
+        event, staged, record = self._staging_copies[idx]
+        event.synchronize()
+        record.copy_(staged)
+        self._staging_copies[idx] = None
+
+    def _sync(self) -> None:
+        for idx in range(self._num_staging_buffers):
+            self._drain(idx)
+        if not self._pending:
+            return
+        for tensor in self._pending:
+            self._append_records(tensor.numpy())
+        self._pending = []
+
+    def _append_records(self, batch: np.ndarray) -> None:
+        if len(batch) > 1:
+            self._records.extend(batch)
+        else:
+            self._records.append(batch)
 
     def _recording_forward(
         self, _: torch.nn.Module, input: torch.Tensor, output: torch.Tensor
-    ) -> torch.Tensor:
+    ) -> None:
+        self._record(self.func(output))
 
-        saliency_map = self.func(output)
-        saliency_map = saliency_map.detach().cpu().numpy()
-        if len(saliency_map) > 1:
-            for tensor in saliency_map:
-                self._records.append(tensor)
-        else:
-            self._records.append(saliency_map)
-
-    def __enter__(self) -> SaliencyMapHook:
+    def __enter__(self) -> BaseAuxiliaryHook:
         self._handle = self._module.register_forward_hook(self._recording_forward)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._handle.remove()
+        self._sync()
+
+
+class EigenCamHook(BaseAuxiliaryHook):
+    """While registered with the designated PyTorch module, this class caches Eigen-CAM saliency maps.
+
+    Feature maps are buffered during forward pass and processed together in a single batched call, which is
+    triggered when the buffer is full, when the feature map shape changes, or when the records are accessed.
+
+    Example::
+        with EigenCamHook(model.module.backbone) as hook:
+            with torch.no_grad():
+                result = model(return_loss=False, **data)
+            print(hook.records)
+    Args:
+        module (torch.nn.Module): The PyTorch module to be registered in forward pass
+        max_pending (int, optional): The maximum number of buffered samples before processing them.
+                                     Defaults to 256.
+        total_samples (int, optional): The number of samples to be recorded. If given, the records are stored in a
+                                       single preallocated buffer. Defaults to None.
+    """
+    def __init__(self, module: torch.nn.Module, max_pending: int = 256, total_samples: Optional[int] = None) -> None:
+        super().__init__(module, total_samples)
+        self._feature_maps = []
+        self._max_pending = max_pending
+
+    @staticmethod
+    def _power_iteration(gram: torch.Tensor, num_iter: int) -> torch.Tensor:
+        """Approximate the leading eigenvector of each symmetric PSD matrix in the batch.
+
+        Args:
+            gram (torch.Tensor): batch of Gram matrices with shape (bs, n, n)
+            num_iter (int): number of power iterations
 
+        Returns:
+            torch.Tensor: unit-norm leading eigenvectors with shape (bs, n, 1)
+        """
+        generator = torch.Generator(device=gram.device)
+        generator.manual_seed(0)
+        # the same initial vector for every sample keeps results independent of how samples are batched
+        v = torch.randn((gram.shape[-1], 1), generator=generator, device=gram.device, dtype=gram.dtype)
+        v = v.expand(gram.shape[0], -1, -1)
+        for _ in range(num_iter):
+            v = gram @ v
+            v = v / v.norm(dim=1, keepdim=True).clamp(min=torch.finfo(v.dtype).tiny)
+        return v
 
-class SaliencyMapHook:
+    @staticmethod
+    def func(x: torch.Tensor, num_iter: int = 5) -> torch.Tensor:
+        """Generate the saliency map by projecting feature maps onto their first principal component.
+
+        Only the leading right singular vector of the centered feature map is needed, so it is approximated by
+        power iteration on the Gram matrix of the smaller side instead of computing a full SVD. On GPU it runs in
+        the dtype of the feature map, e.g. FP16 for models wrapped by wrap_fp16_model.
+
+        Args:
+            x (torch.Tensor): feature maps from backbone with shape (bs, c, h, w)
+            num_iter (int, optional): number of power iterations. Defaults to 5.
+
+        Returns:
+            torch.Tensor: Saliency Map
+        """
+        bs, c, h, w = x.size()
+        if not x.is_cuda:
+            # half precision matmul is not supported on CPU
+            x = x.float()
+        reshaped_fmap = x.reshape((bs, c, h * w)).transpose(1, 2)
+        reshaped_fmap = reshaped_fmap - reshaped_fmap.mean(1)[:, None, :]
+        # unit Frobenius norm bounds the Gram matrix entries by 1 so that it cannot overflow in FP16,
+        # and the saliency map is invariant to this scale after normalization
+        fmap_norm = reshaped_fmap.norm(dim=(1, 2), keepdim=True)
+        reshaped_fmap = reshaped_fmap / fmap_norm.clamp(min=torch.finfo(fmap_norm.dtype).tiny)
+        if h * w < c:
+            # X @ v1 = s1 * u1 and the scale is removed by normalization below, so u1 is the saliency map
+            gram = reshaped_fmap @ reshaped_fmap.transpose(1, 2)
+            saliency_map = EigenCamHook._power_iteration(gram, num_iter).squeeze(-1)
+        else:
+            gram = reshaped_fmap.transpose(1, 2) @ reshaped_fmap
+            v = EigenCamHook._power_iteration(gram, num_iter)
+            saliency_map = (reshaped_fmap @ v).squeeze(-1)
+        saliency_map = saliency_map.reshape((bs, h, w))
+        return _normalize_uint8(saliency_map)
+
+    def _flush(self) -> None:
+        if not self._feature_maps:
+            return
+        feature_maps = torch.cat(self._feature_maps, 0)
+        batch_sizes = [len(feature_map) for feature_map in self._feature_maps]
+        self._feature_maps = []
+        for saliency_map in torch.split(self.func(feature_maps), batch_sizes):
+            self._record(saliency_map)
+
+    def _sync(self) -> None:
+        self._flush()
+        super()._sync()
+
+    def _recording_forward(
+        self, _: torch.nn.Module, input: torch.Tensor, output: torch.Tensor
+    ) -> None:
+        output = output.detach()
+        if self._feature_maps and self._feature_maps[0].shape[1:] != output.shape[1:]:
+            self._flush()
+        self._feature_maps.append(output)
+        if sum(len(feature_map) for feature_map in self._feature_maps) >= self._max_pending:
+            self._flush()
+
+
+class SaliencyMapHook(BaseAuxiliaryHook):
     """While registered with the designated PyTorch module, this class caches saliency maps during forward pass.
 
     Example::
@@ -78,17 +273,13 @@ class SaliencyMapHook:
         module (torch.nn.Module): The PyTorch module to be registered in forward pass
         _fpn_idx (int, optional): The layer index to be processed if the model is a FPN. 
                                   Defaults to 0 which uses the largest feature map from FPN.
+        total_samples (int, optional): The number of samples to be recorded. If given, the records are stored in a
+                                       single preallocated buffer. Defaults to None.
     """
-    def __init__(self, module: torch.nn.Module, _fpn_idx: int = 0) -> None:
-        self._module = module
-        self._handle = None
-        self._records = []
+    def __init__(self, module: torch.nn.Module, _fpn_idx: int = 0, total_samples: Optional[int] = None) -> None:
+        super().__init__(module, total_samples)
         self._fpn_idx = _fpn_idx
 
-    @property
-    def records(self):
-        return self._records
-
     @staticmethod
     def func(feature_map: Union[torch.Tensor, list[torch.Tensor]], _fpn_idx: int = 0) -> torch.Tensor:
         """Generate the saliency map by average feature maps then normalizing to (0, 255).
@@ -105,37 +296,21 @@ class SaliencyMapHook:
         if isinstance(feature_map, list):
             feature_map = feature_map[_fpn_idx]
 
-        bs, c, h, w = feature_map.size()
-        saliency_map = torch.mean(feature_map, dim=1)
-        saliency_map = saliency_map.reshape((bs, h * w))
-        max_values, _ = torch.max(saliency_map, -1)
-        min_values, _ = torch.min(saliency_map, -1)
-        saliency_map = (
-            255
-            * (saliency_map - min_values[:, None])
-            / (max_values - min_values + 1e-12)[:, None]
-        )
-        saliency_map = saliency_map.reshape((bs, h, w))
-        saliency_map = saliency_map.to(torch.uint8)
-        return saliency_map
+        # min-max normalization is scale invariant, so the channel sum gives the same map as the channel mean.
+        # It is accumulated in float32 because the sum of FP16 feature maps can overflow.
+        saliency_map = torch.sum(feature_map, dim=1, dtype=torch.float32)
+        return _normalize_uint8(saliency_map)
+
+    def _append_records(self, batch: np.ndarray) -> None:
+        self._records.extend(batch)
 
     def _recording_forward(
         self, _: torch.nn.Module, input: torch.Tensor, output: torch.Tensor
-    ) -> torch.Tensor:
-        saliency_map = self.func(output, self._fpn_idx)
-        saliency_map = saliency_map.detach().cpu().numpy()
-        for tensor in saliency_map:
-            self._records.append(tensor)
-
-    def __enter__(self) -> SaliencyMapHook:
-        self._handle = self._module.register_forward_hook(self._recording_forward)
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self._handle.remove()
+    ) -> None:
+        self._record(self.func(output, self._fpn_idx))
 
 
-class FeatureVectorHook:
+class FeatureVectorHook(BaseAuxiliaryHook):
     """While registered with the designated PyTorch module, this class caches feature vector during forward pass.
 
     Example::
@@ -145,16 +320,9 @@ class FeatureVectorHook:
             print(hook.records)
     Args:
         module (torch.nn.Module): The PyTorch module to be registered in forward pass
+        total_samples (int, optional): The number of samples to be recorded. If given, the records are stored in a
+                                       single preallocated buffer. Defaults to None.
     """
-    def __init__(self, module: torch.nn.Module) -> None:
-        self._module = module
-        self._handle = None
-        self._records = []
-
-    @property
-    def records(self):
-        return self._records
-
     @staticmethod
     def func(feature_map: Union[torch.Tensor, list[torch.Tensor]]) -> torch.Tensor:
         """Generate the feature vector by average pooling feature maps.
@@ -171,24 +339,40 @@ class FeatureVectorHook:
         """ 
         if isinstance(feature_map, list):
             # aggregate feature maps from Feature Pyramid Network
-            feature_vector = [torch.nn.functional.adaptive_avg_pool2d(f, (1, 1)) for f in feature_map]
-            feature_vector = torch.cat(feature_vector, 1)
+            feature_vector = torch.cat([f.mean(dim=(2, 3), keepdim=True) for f in feature_map], 1)
         else:
-            feature_vector = torch.nn.functional.adaptive_avg_pool2d(feature_map, (1, 1))
-        return feature_vector        
+            feature_vector = feature_map.mean(dim=(2, 3), keepdim=True)
+        return feature_vector
+
+
+class MultiAuxiliaryHook:
+    """While registered with the designated PyTorch module, this class runs several auxiliary hooks on its output.
+
+    The given hooks are not registered themselves but share a single forward hook, and each keeps its own records.
+
+    Example::
+        fhook = FeatureVectorHook(model.module.backbone)
+        shook = SaliencyMapHook(model.module.backbone)
+        with MultiAuxiliaryHook(model.module.backbone, [fhook, shook]):
+            with torch.no_grad():
+                result = model(return_loss=False, **data)
+            print(fhook.records, shook.records)
+    Args:
+        module (torch.nn.Module): The PyTorch module to be registered in forward pass
+        hooks (list[BaseAuxiliaryHook]): The hooks to be run on the output of the module
+    """
+    def __init__(self, module: torch.nn.Module, hooks: list[BaseAuxiliaryHook]) -> None:
+        self._module = module
+        self._handle = None
+        self._hooks = hooks
 
     def _recording_forward(
-        self, _: torch.nn.Module, input: torch.Tensor, output: torch.Tensor
-    ) -> torch.Tensor:
-        feature_vector = self.func(output)
-        feature_vector = feature_vector.detach().cpu().numpy()
-        if len(feature_vector) > 1:
-            for tensor in feature_vector:
-                self._records.append(tensor)
-        else:
-            self._records.append(feature_vector)
+        self, module: torch.nn.Module, input: torch.Tensor, output: torch.Tensor
+    ) -> None:
+        for hook in self._hooks:
+            hook._recording_forward(module, input, output)
 
-    def __enter__(self) -> FeatureVectorHook:
+    def __enter__(self) -> MultiAuxiliaryHook:
         self._handle = self._module.register_forward_hook(self._recording_forward)
         return self
 